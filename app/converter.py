@@ -1,14 +1,23 @@
+import functools
+import hashlib
 import io
 import re
 import tempfile
 import os
-from collections import Counter
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pymupdf
 import pymupdf4llm
 import mammoth
 from markdownify import markdownify
 
+try:
+    from lxml import html as lxml_html
+except ImportError:  # fall back to markdownify for the DOCX path
+    lxml_html = None
+
 # Margin zone in points (1 point = 1/72 inch). Text spans falling inside
 # this zone AND matching the short-text heuristic are treated as paraphs.
 _MARGIN_LEFT = 50
@@ -23,30 +32,100 @@ _HANDWRITING_KEYWORDS = [
 ]
 
 # Pattern: meaningful handwritten content (dates, amounts) we want to KEEP.
+# The currency branch requires a leading digit — an amount, not a bare
+# currency mention — which also makes the digit prefilter below sound.
 _MEANINGFUL_RE = re.compile(
     r"\d{1,2}[./\-]\d{1,2}[./\-]\d{2,4}"  # dates
-    r"|[\d\s,.]+\s*(zl|PLN|USD|EUR|pln|zł)"  # amounts with currency
+    r"|\d[\d\s,.]*\s*(zl|PLN|USD|EUR|pln|zł)"  # amounts with currency
     r"|\d+[.,]\d{2}"  # decimal amounts
 )
 
+# Every _MEANINGFUL_RE branch starts with \d, so a C-level digit-presence
+# test prunes the regex for the vast majority of spans.
+_DEL_DIGITS = str.maketrans("", "", "0123456789")
+
+
+def _is_meaningful(text: str) -> bool:
+    return (
+        len(text) != len(text.translate(_DEL_DIGITS))
+        and _MEANINGFUL_RE.search(text) is not None
+    )
+
 
 _OCR_FONTS = {"glyphlessfont", "cid", "invisible"}
 
+# A plausible OCR'd word: plain Polish/English letters with basic
+# punctuation, 2-30 chars. Used to score page quality on OCR documents.
+_CLEAN_WORD_RE = re.compile(
+    r'[a-zA-ZąćęłńóśźżĄĆĘŁŃÓŚŹŻ.,;:\-()"\'„"]{2,30}\Z'
+)
+
 
-def _needs_ocr(file_bytes: bytes, threshold: float = 0.10) -> bool:
+def _has_significant_text(text: str, limit: int = 50) -> bool:
+    """True if the page text has more than `limit` non-whitespace chars.
+
+    Three C-level str.count calls instead of allocating a stripped copy
+    of the page text just to measure it.
+    """
+    return (
+        len(text) - text.count(" ") - text.count("\n") - text.count("\t")
+        > limit
+    )
+
+
+def _needs_ocr(doc: pymupdf.Document, threshold: float = 0.10) -> bool:
     """Check if a PDF is a pure image scan without a text layer.
 
     Returns True if fewer than `threshold` fraction of pages contain
     meaningful text (>50 characters). Fast — only extracts text, no OCR.
+    The caller owns the document and keeps it open.
     """
-    doc = pymupdf.open(stream=file_bytes, filetype="pdf")
     total = len(doc)
     if total == 0:
-        doc.close()
         return False
-    with_text = sum(1 for p in doc if len(p.get_text().strip()) > 50)
-    doc.close()
-    return with_text / total < threshold
+    # The decision is monotone, so stop as soon as it is settled: enough
+    # text-bearing pages means no OCR, too few possible means OCR.
+    needed = threshold * total
+    with_text = 0
+    for i, page in enumerate(doc):
+        if _has_significant_text(page.get_text()):
+            with_text += 1
+            if with_text >= needed:
+                return False
+        if with_text + (total - i - 1) < needed:
+            return True
+    return with_text < needed
+
+
+# OCR takes tens of seconds per document, so results are cached on disk
+# keyed by a content hash of the input bytes (re-uploads and web-app
+# retries of the same file skip ocrmypdf entirely).
+_OCR_CACHE_DIR = os.path.join(tempfile.gettempdir(), "konwerter_ocr_cache")
+_OCR_CACHE_MAX_ENTRIES = 16
+
+
+def _ocr_cache_path(file_bytes: bytes) -> str:
+    key = hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+    return os.path.join(_OCR_CACHE_DIR, key + ".pdf")
+
+
+def _ocr_cache_store(cache_path: str, data: bytes) -> None:
+    """Best-effort cache write with LRU-by-mtime eviction."""
+    try:
+        os.makedirs(_OCR_CACHE_DIR, exist_ok=True)
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, cache_path)
+        entries = sorted(
+            (os.path.join(_OCR_CACHE_DIR, name)
+             for name in os.listdir(_OCR_CACHE_DIR) if name.endswith(".pdf")),
+            key=os.path.getmtime,
+        )
+        for old_path in entries[:-_OCR_CACHE_MAX_ENTRIES]:
+            os.unlink(old_path)
+    except OSError:
+        pass  # cache is an optimization — never fail the conversion
 
 
 def _ocr_pdf(file_bytes: bytes, language: str = "pol+eng") -> bytes:
@@ -60,251 +139,367 @@ def _ocr_pdf(file_bytes: bytes, language: str = "pol+eng") -> bytes:
     """
     import subprocess
 
-    in_path = None
-    out_path = None
+    cache_path = _ocr_cache_path(file_bytes)
     try:
-        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp_in:
-            tmp_in.write(file_bytes)
-            in_path = tmp_in.name
-
-        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp_out:
-            out_path = tmp_out.name
-
-        result = subprocess.run(
-            [
-                "ocrmypdf",
-                "--skip-text",
-                "--deskew",
-                "--optimize", "0",
-                "-l", language,
-                in_path,
-                out_path,
-            ],
-            capture_output=True,
-            text=True,
-        )
-
-        if result.returncode != 0:
-            stderr = result.stderr.strip()
-            if "PriorOcrFoundError" in stderr:
-                return file_bytes
-            if "tesseract" in stderr.lower() and "not found" in stderr.lower():
-                raise RuntimeError(
-                    "OCR wymaga zainstalowanego Tesseract. "
-                    "macOS: brew install tesseract tesseract-lang | "
-                    "Linux: apt install tesseract-ocr tesseract-ocr-pol"
-                )
-            raise RuntimeError(f"ocrmypdf error: {stderr}")
-
-        with open(out_path, "rb") as f:
+        with open(cache_path, "rb") as f:
             return f.read()
+    except OSError:
+        pass
+
+    # "-" "-" streams the PDF through stdin/stdout — no temp files on disk
+    result = subprocess.run(
+        [
+            "ocrmypdf",
+            "--skip-text",
+            "--deskew",
+            "--optimize", "0",
+            "-l", language,
+            "-",
+            "-",
+        ],
+        input=file_bytes,
+        capture_output=True,
+    )
 
-    finally:
-        if in_path and os.path.exists(in_path):
-            os.unlink(in_path)
-        if out_path and os.path.exists(out_path):
-            os.unlink(out_path)
-
-
-def _get_font_stats(doc: pymupdf.Document) -> tuple[str, bool]:
-    """Return (dominant_font_name, is_ocr_document).
-
-    A document is considered OCR if all text uses OCR-specific fonts
-    like GlyphLessFont (Tesseract) or similar invisible text fonts.
-    """
-    font_counter: Counter[str] = Counter()
-    for page in doc:
-        blocks = page.get_text("dict", flags=pymupdf.TEXTFLAGS_TEXT)["blocks"]
-        for block in blocks:
-            for line in block.get("lines", []):
-                for span in line["spans"]:
-                    text = span["text"].strip()
-                    if text:
-                        font_counter[span["font"]] += len(text)
-    if not font_counter:
-        return "", False
-
-    dominant = font_counter.most_common(1)[0][0]
-    all_ocr = all(f.lower() in _OCR_FONTS for f in font_counter)
-    return dominant, all_ocr
+    if result.returncode != 0:
+        stderr = result.stderr.decode("utf-8", errors="replace").strip()
+        if "PriorOcrFoundError" in stderr:
+            _ocr_cache_store(cache_path, file_bytes)
+            return file_bytes
+        if "tesseract" in stderr.lower() and "not found" in stderr.lower():
+            raise RuntimeError(
+                "OCR wymaga zainstalowanego Tesseract. "
+                "macOS: brew install tesseract tesseract-lang | "
+                "Linux: apt install tesseract-ocr tesseract-ocr-pol"
+            )
+        raise RuntimeError(f"ocrmypdf error: {stderr}")
+
+    _ocr_cache_store(cache_path, result.stdout)
+    return result.stdout
+
+
+# One alternation over all keywords instead of 10 substring scans
+_HANDWRITING_RE = re.compile(
+    "|".join(map(re.escape, _HANDWRITING_KEYWORDS)), re.IGNORECASE
+)
 
 
+@functools.lru_cache(maxsize=256)
 def _is_handwriting_font(font_name: str) -> bool:
-    low = font_name.lower()
-    return any(kw in low for kw in _HANDWRITING_KEYWORDS)
+    return _HANDWRITING_RE.search(font_name) is not None
 
 
-def _span_in_margin(bbox: tuple, page_rect: pymupdf.Rect) -> bool:
-    """Check if a span's bounding box falls within the page margin zone."""
-    x0, y0, x1, y1 = bbox
+def _margin_mask(bboxes: np.ndarray, page_rect: pymupdf.Rect) -> np.ndarray:
+    """Vectorized margin test: bool mask of spans whose bbox falls within
+    the page margin zone. `bboxes` is an (N, 4) float array."""
     return (
-        x0 < page_rect.x0 + _MARGIN_LEFT
-        or x1 > page_rect.x1 - _MARGIN_RIGHT
-        or y0 < page_rect.y0 + _MARGIN_TOP
-        or y1 > page_rect.y1 - _MARGIN_BOTTOM
+        (bboxes[:, 0] < page_rect.x0 + _MARGIN_LEFT)
+        | (bboxes[:, 2] > page_rect.x1 - _MARGIN_RIGHT)
+        | (bboxes[:, 1] < page_rect.y0 + _MARGIN_TOP)
+        | (bboxes[:, 3] > page_rect.y1 - _MARGIN_BOTTOM)
     )
 
 
-def _is_margin_paraph(span: dict, page_rect: pymupdf.Rect,
-                      dominant_font: str) -> bool:
-    """Decide whether a text span is a handwritten margin paraph to remove.
-
-    Keep the span if it contains meaningful content (dates, amounts).
-    """
-    text = span["text"].strip()
-    if not text:
-        return False
+# Documents at least this long are scanned on a thread pool
+_PARALLEL_MIN_PAGES = 8
 
-    # Always keep meaningful content (dates, amounts)
-    if _MEANINGFUL_RE.search(text):
-        return False
 
-    in_margin = _span_in_margin(span["bbox"], page_rect)
-    is_hw_font = _is_handwriting_font(span["font"])
-    is_foreign_font = span["font"] != dominant_font
-    is_short = len(text) <= 4
+def _scan_page(page: pymupdf.Page) -> tuple:
+    """Extract everything the analysis needs from one page in a single
+    get_text("dict") call: per-font character counts, header- and
+    footer-zone text sets and span arrays for the redaction phase.
 
-    # Definite paraph: handwriting font in margin
-    if is_hw_font and in_margin:
-        return True
+    Header/footer detection alone would get by on the much lighter
+    get_text("blocks") tuples, but the same pass must also see span
+    fonts and bboxes for the paraph heuristic, so one "dict" extraction
+    beats a "blocks" + "dict" pair.
+    """
+    page_rect = page.rect
+    # Zone: top 10% or bottom 10% of page, judged by the span's
+    # y-midpoint — edge tests would drag tall body spans (large-font
+    # titles) into the zones.
+    header_limit = page_rect.height * 0.10
+    footer_limit = page_rect.height * 0.90
+    blocks = page.get_text("dict", flags=pymupdf.TEXTFLAGS_TEXT)["blocks"]
+    fonts_on_page: Counter[str] = Counter()
+    header_texts: set[str] = set()
+    footer_texts: set[str] = set()
+    bboxes: list[tuple] = []
+    fonts: list[str] = []
+    texts: list[str] = []
+    for block in blocks:
+        for line in block.get("lines", ()):
+            for span in line["spans"]:
+                text = span["text"].strip()
+                if not text:
+                    continue
+                font = span["font"]
+                fonts_on_page[font] += len(text)
+                bbox = span["bbox"]
+                y_mid = (bbox[1] + bbox[3]) / 2
+                if y_mid < header_limit:
+                    header_texts.add(text)
+                elif y_mid > footer_limit:
+                    footer_texts.add(text)
+                bboxes.append(bbox)
+                fonts.append(font)
+                texts.append(text)
+    return fonts_on_page, (header_texts, footer_texts), (
+        page_rect, bboxes, fonts, texts,
+    )
 
-    # Short text in margin with a non-dominant font — likely initials/paraph
-    if in_margin and is_short and is_foreign_font:
-        return True
 
-    return False
+def _scan_pages_parallel(file_bytes: bytes, total: int) -> list[tuple]:
+    """Scan all pages on a thread pool, returning per-page _scan_page
+    results in page order.
 
+    PyMuPDF objects must not be shared across threads, so each worker
+    opens its own Document view of the same bytes; get_text releases the
+    GIL during native parsing, which is where the time goes.
+    """
+    max_workers = min(os.cpu_count() or 1, total)
+    step = (total + max_workers - 1) // max_workers
+    ranges = [(start, min(start + step, total))
+              for start in range(0, total, step)]
+
+    def scan_range(bounds: tuple[int, int]) -> list[tuple]:
+        start, stop = bounds
+        sub = pymupdf.open(stream=file_bytes, filetype="pdf")
+        try:
+            return [_scan_page(sub[i]) for i in range(start, stop)]
+        finally:
+            sub.close()
+
+    with ThreadPoolExecutor(max_workers=len(ranges)) as ex:
+        chunks = list(ex.map(scan_range, ranges))
+    return [result for chunk in chunks for result in chunk]
+
+
+def _analyze_and_clean(
+    doc: pymupdf.Document, file_bytes: bytes | None = None
+) -> tuple[bool, set[str], list[int] | None]:
+    """Analyze fonts, find recurring headers/footers and redact margin
+    paraphs in a single traversal of the document.
+
+    page.get_text("dict") dominates the preprocessing cost, so instead of
+    three separate passes (font stats, recurring-text detection, paraph
+    cleaning) each page is extracted exactly once; on longer documents
+    the scan runs on a thread pool (requires `file_bytes`, since workers
+    need their own Document views). Paraph candidates are collected
+    during the scan and redacted afterwards, once the dominant font is
+    known. Redactions mutate `doc` in place and are skipped for OCR
+    documents (single font — heuristic won't work). Dates, amounts and
+    all main-body text are kept intact.
+
+    Returns (is_ocr, recurring_header_footer_texts, good_pages).
+    A document is considered OCR if all text uses OCR-specific fonts
+    like GlyphLessFont (Tesseract) or similar invisible text fonts; for
+    OCR documents good_pages lists the pages with acceptable text
+    quality (garbled KRS appendixes etc. are dropped), scored from the
+    span texts already extracted — no second get_text pass.
+    """
+    font_counter: Counter[str] = Counter()
+    # Per-page (header_texts, footer_texts) sets from the 10% zones
+    page_zones: list[tuple[set[str], set[str]]] = []
+    # Per-page span arrays (structure-of-arrays) for the redaction phase
+    page_spans: list[tuple[pymupdf.Rect, list, list, list]] = []
+
+    if file_bytes is not None and len(doc) >= _PARALLEL_MIN_PAGES:
+        scanned = _scan_pages_parallel(file_bytes, len(doc))
+    else:
+        scanned = [_scan_page(page) for page in doc]
+    for fonts_on_page, zones, spans in scanned:
+        font_counter.update(fonts_on_page)
+        page_zones.append(zones)
+        page_spans.append(spans)
 
-def _clean_pdf(file_bytes: bytes, is_ocr: bool, dominant_font: str) -> bytes:
-    """Remove handwritten margin paraphs from a PDF, return cleaned PDF bytes.
+    if not font_counter:
+        return False, set(), None
+
+    dominant_font = font_counter.most_common(1)[0][0]
+    is_ocr = all(f.lower() in _OCR_FONTS for f in font_counter)
+
+    # Text is recurring if it appears in the same zone on 2+ pages, as
+    # documented. Counting instead of intersecting means a cover page
+    # without the header no longer masks detection.
+    recurring: set[str] = set()
+    if len(page_zones) >= 2:
+        header_counts: Counter[str] = Counter()
+        footer_counts: Counter[str] = Counter()
+        for header_texts, footer_texts in page_zones:
+            header_counts.update(header_texts)
+            footer_counts.update(footer_texts)
+        recurring = {t for t, c in header_counts.items() if c >= 2}
+        recurring.update(t for t, c in footer_counts.items() if c >= 2)
+
+    # A single-font document (machine-generated invoices, reports) can't
+    # contain a foreign-font paraph, and unless that one font is itself a
+    # handwriting face no span can be redacted — skip the phase entirely.
+    single_clean_font = (
+        len(font_counter) == 1 and not _is_handwriting_font(dominant_font)
+    )
 
-    Skipped for OCR documents (single font — heuristic won't work).
-    Keeps dates, amounts, and all main-body text intact.
-    """
+    if not is_ocr and not single_clean_font:
+        # Intern font names into ids so the per-span font tests become
+        # array indexing; the handwriting test runs once per unique font
+        font_ids = {f: i for i, f in enumerate(font_counter)}
+        hw_mask = np.fromiter(
+            (_is_handwriting_font(f) for f in font_counter),
+            bool, len(font_ids),
+        )
+        dominant_id = font_ids[dominant_font]
+        dirty_pages: list[pymupdf.Page] = []
+        for page_index, (page_rect, bboxes, fonts, texts) in enumerate(page_spans):
+            if not bboxes:
+                continue
+            n = len(bboxes)
+            in_margin = _margin_mask(
+                np.asarray(bboxes, dtype=np.float32), page_rect
+            )
+            if not in_margin.any():
+                continue
+            ids = np.fromiter(map(font_ids.__getitem__, fonts), np.int32, n)
+            is_hw = hw_mask[ids]
+            is_foreign = ids != dominant_id
+            is_short = np.fromiter((len(t) <= 4 for t in texts), bool, n)
+            # Definite paraph: handwriting font in margin. Otherwise short
+            # text in a non-dominant font — likely initials/paraph.
+            mask = in_margin & (is_hw | (is_short & is_foreign))
+            idx = np.nonzero(mask)[0]
+            # Always keep meaningful content (dates, amounts)
+            meaningful = map(_is_meaningful, (texts[i] for i in idx))
+            page = None
+            for i, found in zip(idx, meaningful):
+                if found:
+                    continue
+                if page is None:
+                    page = doc[page_index]
+                page.add_redact_annot(pymupdf.Rect(bboxes[i]))
+            if page is not None:
+                dirty_pages.append(page)
+        for page in dirty_pages:
+            page.apply_redactions()
+
+    # For OCR: skip pages with very low text quality, scored on the span
+    # texts collected above instead of re-extracting every page
+    good_pages = None
     if is_ocr:
-        return file_bytes
+        good_pages = []
+        for i, (_rect, _bboxes, _fonts, texts) in enumerate(page_spans):
+            words = " ".join(texts).split()
+            total_words = len(words)
+            if not total_words:
+                continue
+            # Stop scanning once the 55% verdict is settled either way
+            clean = 0
+            for j, w in enumerate(words):
+                if _CLEAN_WORD_RE.match(w):
+                    clean += 1
+                    if clean / total_words >= 0.55:
+                        good_pages.append(i)
+                        break
+                elif (clean + total_words - j - 1) / total_words < 0.55:
+                    break
+        good_pages = good_pages or None
 
-    doc = pymupdf.open(stream=file_bytes, filetype="pdf")
+    return is_ocr, recurring, good_pages
 
-    for page in doc:
-        page_rect = page.rect
-        blocks = page.get_text("dict", flags=pymupdf.TEXTFLAGS_TEXT)["blocks"]
 
-        for block in blocks:
-            for line in block.get("lines", []):
-                for span in line["spans"]:
-                    if _is_margin_paraph(span, page_rect, dominant_font):
-                        rect = pymupdf.Rect(span["bbox"])
-                        page.add_redact_annot(rect)
+# Classifies a stripped markdown line with one match; m.lastgroup names
+# the class.
+_LINE_CLASSIFIER = re.compile(
+    # List item marker: "1. ", "- ", "* ", "+ "
+    r"(?P<list>(?:\d+\.|[-*+])\s)"
+    # Other structural elements that must never be merged into paragraphs:
+    # headings, tables, code fences, horizontal rules, images
+    r"|(?P<struct>#|\||```|---|\*\*\*|___|!\[)"
+)
 
-        page.apply_redactions()
 
-    cleaned = doc.tobytes()
-    doc.close()
-    return cleaned
+def _classify_line(stripped: str) -> str | None:
+    """Classify a stripped markdown line in one regex match.
 
+    Returns "list" (list item), "struct" (other structural element)
+    or None (regular text).
+    """
+    m = _LINE_CLASSIFIER.match(stripped)
+    return m.lastgroup if m else None
 
-def _find_recurring_texts(doc: pymupdf.Document) -> set[str]:
-    """Find text fragments that repeat at the same position across pages.
 
-    These are headers/footers (e.g. document title, page numbers).
-    Returns the set of text strings to strip from output.
-    """
-    if len(doc) < 2:
-        return set()
-
-    # Collect (text, approximate_y_zone) per page
-    page_texts: list[set[tuple[str, int]]] = []
-    for page in doc:
-        texts_on_page: set[tuple[str, int]] = set()
-        blocks = page.get_text("dict", flags=pymupdf.TEXTFLAGS_TEXT)["blocks"]
-        page_h = page.rect.height
-        for block in blocks:
-            for line in block.get("lines", []):
-                for span in line["spans"]:
-                    text = span["text"].strip()
-                    if not text:
-                        continue
-                    y_mid = (span["bbox"][1] + span["bbox"][3]) / 2
-                    # Zone: top 10% or bottom 10% of page
-                    if y_mid < page_h * 0.10:
-                        zone = 0  # header zone
-                    elif y_mid > page_h * 0.90:
-                        zone = 1  # footer zone
-                    else:
-                        continue  # not in header/footer zone
-                    texts_on_page.add((text, zone))
-        page_texts.append(texts_on_page)
-
-    # Text is recurring if it appears on 2+ pages in the same zone
-    if not page_texts:
-        return set()
-
-    all_pairs = page_texts[0]
-    for pt in page_texts[1:]:
-        all_pairs = all_pairs & pt
-
-    return {text for text, _zone in all_pairs}
-
-
-_PAGE_NUMBER_RE = re.compile(
-    r"^[-–—]?\s*\d{1,4}\s*[-–—]?$"        # "- 1 -", "1", "—2—"
-    r"|^(strona|str\.?|page|p\.?)\s*\d+$"  # "strona 1", "page 3"
-    r"|^\d+\s*/\s*\d+$",                   # "1 / 5"
-    re.IGNORECASE,
+# Page-number forms, each a small anchored pattern with no alternation
+# to backtrack through. _is_page_number picks one based on the first
+# character, so most lines never reach a regex at all.
+_DASHED_NUM_RE = re.compile(r"[-–—]?\s*\d{1,4}\s*[-–—]?$")    # "- 1 -", "—2—"
+_NUM_SLASH_RE = re.compile(r"\d+\s*/\s*\d+$")                 # "1 / 5"
+_LABELED_PAGE_RE = re.compile(                                # "strona 1"
+    r"(?:strona|str\.?|page|p\.?)\s*\d+$", re.IGNORECASE
 )
 
 
-def _remove_headers_footers(md: str, recurring: set[str]) -> str:
-    """Remove recurring header/footer text and page numbers from markdown."""
-    if not recurring:
-        return md
+def _is_page_number(stripped: str) -> bool:
+    """Check if a non-empty stripped line is a standalone page number."""
+    # isdecimal, not isdigit: superscripts like "²" are not \d and were
+    # never page numbers
+    if stripped.isdecimal():
+        return len(stripped) <= 4
+    first = stripped[0]
+    if first.isdigit() or first in "-–—":
+        return (
+            _DASHED_NUM_RE.match(stripped) is not None
+            or _NUM_SLASH_RE.match(stripped) is not None
+        )
+    if first in "psPS":
+        return _LABELED_PAGE_RE.match(stripped) is not None
+    return False
 
-    lines = md.split("\n")
-    cleaned = []
-    for line in lines:
-        stripped = line.strip().strip("*").strip("#").strip()
-        if stripped in recurring:
-            continue
-        cleaned.append(line)
-    return "\n".join(cleaned)
 
+_HEADER_BOLD_RE = re.compile(r"^(#{1,6})\s+\*\*(.+?)\*\*\s*$")
 
-def _remove_page_numbers(md: str) -> str:
-    """Remove standalone page number lines."""
-    lines = md.split("\n")
+# str.strip char-sets trimming markdown decoration in one C-level pass:
+# whitespace/bold/heading markers (canonical form for the recurring-text
+# test) and whitespace/bold only (page-number test — '#' must survive so
+# headings like '# 5' aren't mistaken for page numbers).
+_TRIM_DECOR = " \t\r\n*#"
+_TRIM_BOLD = " \t\r\n*"
+
+
+def _cleanup_md(md: str, recurring: set[str]) -> str:
+    """Single-pass markdown cleanup.
+
+    Drops recurring header/footer lines, drops standalone page number
+    lines, and fixes redundant bold inside headers ('# **text**' ->
+    '# text') — in one split/join instead of three, so large outputs
+    are not re-materialized per rule.
+    """
+    recurring = frozenset(recurring)
+    # Lines shorter than the shortest recurring text can never match —
+    # skip the trim allocation for them entirely.
+    min_recurring_len = min(map(len, recurring)) if recurring else 0
+    # Hoist the method lookups out of the per-line loop
+    is_page_number = _is_page_number
+    fix_bold = _HEADER_BOLD_RE.sub
     cleaned = []
-    for line in lines:
-        stripped = line.strip().strip("*").strip()
-        if stripped and _PAGE_NUMBER_RE.match(stripped):
+    append = cleaned.append
+    for line in md.split("\n"):
+        if recurring and len(line) >= min_recurring_len:
+            if line.strip(_TRIM_DECOR) in recurring:
+                continue
+        stripped = line.strip(_TRIM_BOLD)
+        if stripped and is_page_number(stripped):
             continue
-        cleaned.append(line)
+        if line.startswith("#"):
+            line = fix_bold(r"\1 \2", line)
+        append(line)
     return "\n".join(cleaned)
 
 
-def _clean_header_formatting(md: str) -> str:
-    """Fix redundant bold inside headers: '# **text**' -> '# text'."""
-    return re.sub(
-        r"^(#{1,6})\s+\*\*(.+?)\*\*\s*$",
-        r"\1 \2",
-        md,
-        flags=re.MULTILINE,
-    )
+# List item marker: "1. ", "- ", "* ", "+ "
+_LIST_ITEM_RE = re.compile(r"(\d+\.|[-*+])\s")
 
 
 def _is_structural_line(line: str) -> bool:
     """Check if a line is a Markdown structural element that should not be merged."""
-    s = line.strip()
-    return bool(
-        s.startswith("#")
-        or s.startswith("|")
-        or s.startswith("```")
-        or s.startswith("---")
-        or s.startswith("***")
-        or s.startswith("___")
-        or s.startswith("![")
-        or re.match(r"^(\d+\.|[-*+])\s", s)
-    )
+    return _classify_line(line.strip()) is not None
 
 
 def _is_list_continuation(text: str, prev_block: str) -> bool:
@@ -313,7 +508,7 @@ def _is_list_continuation(text: str, prev_block: str) -> bool:
         return False
     # Previous block ends with a list item
     last_line = prev_block.strip().split("\n")[-1]
-    if not re.match(r"^(\d+\.|[-*+])\s", last_line.strip()):
+    if not _LIST_ITEM_RE.match(last_line.strip()):
         return False
     # This text doesn't start a new structural element
     stripped = text.strip()
@@ -323,7 +518,7 @@ def _is_list_continuation(text: str, prev_block: str) -> bool:
     if stripped and not stripped[0].isupper():
         return True
     # If it doesn't start with a number/bullet, treat as continuation
-    if not re.match(r"^(\d+\.|[-*+])\s", stripped):
+    if not _LIST_ITEM_RE.match(stripped):
         return True
     return False
 
@@ -363,39 +558,30 @@ def _merge_broken_lines(md: str) -> str:
             result_blocks.append("\n".join(lines))
             continue
 
-        # Merge continuation lines within the block
+        # Merge continuation lines within the block. `current` collects
+        # the pieces of the open paragraph/list item and is joined once
+        # on flush — repeated `+=` would be O(n^2) over the block.
         merged_lines = []
-        current = ""
+        current: list[str] = []
         for line in lines:
             stripped = line.strip()
-            is_struct = _is_structural_line(line)
-            is_list = bool(re.match(r"^(\d+\.|[-*+])\s", stripped))
-            is_heading = stripped.startswith("#")
-            is_table = stripped.startswith("|")
-
-            if is_heading or is_table:
+            first = stripped[0]  # never empty — blanks filtered above
+            if first == "#" or first == "|":
                 # Headings and tables always stand alone
                 if current:
-                    merged_lines.append(current)
-                    current = ""
+                    merged_lines.append(" ".join(current))
+                    current = []
                 merged_lines.append(stripped)
-            elif is_list:
+            elif _classify_line(stripped) == "list":
                 # New list item — finalize previous, start accumulating
                 if current:
-                    merged_lines.append(current)
-                    current = ""
-                current = stripped
-            elif current and re.match(r"^(\d+\.|[-*+])\s", current):
-                # Continuation of a list item
-                current += " " + stripped
+                    merged_lines.append(" ".join(current))
+                current = [stripped]
             else:
-                # Regular text — merge with current
-                if current:
-                    current += " " + stripped
-                else:
-                    current = stripped
+                # Continuation of a list item or regular text — merge
+                current.append(stripped)
         if current:
-            merged_lines.append(current)
+            merged_lines.append(" ".join(current))
 
         merged_block = "\n\n".join(merged_lines)
 
@@ -421,15 +607,19 @@ def _strip_ocr_backticks(md: str) -> str:
     return md
 
 
-_VOWELS = set("aeiouyąęóAEIOUYĄĘÓ")
+# Counting helpers for _is_garbage_word — each runs as a single C-level
+# pass over the word instead of a per-character Python loop.
+_NON_LETTER_RE = re.compile(r"[\W\d_]+")
+_DEL_VOWELS = str.maketrans("", "", "aeiouyąęóAEIOUYĄĘÓ")
+_CASE_TRANSITION_RE = re.compile(r"[a-ząćęłńóśźż][A-ZĄĆĘŁŃÓŚŹŻ]")
 
 
 def _is_garbage_word(word: str) -> bool:
     """Check if a word looks like garbled OCR output."""
-    letters = [c for c in word if c.isalpha()]
+    letters = _NON_LETTER_RE.sub("", word)
     if len(letters) < 3:
         return False
-    vowels = sum(1 for c in letters if c in _VOWELS)
+    vowels = len(letters) - len(letters.translate(_DEL_VOWELS))
     # Real Polish/English words have at least ~20% vowels
     if vowels / len(letters) < 0.15:
         return True
@@ -437,9 +627,7 @@ def _is_garbage_word(word: str) -> bool:
     if len(letters) > 20:
         return True
     # Concatenated words: lowercase→uppercase transition mid-word (e.g. wpisówBrak)
-    transitions = sum(1 for i in range(1, len(word) - 1)
-                      if word[i].islower() and word[i + 1].isupper())
-    if transitions >= 2:
+    if len(_CASE_TRANSITION_RE.findall(word, 1)) >= 2:
         return True
     return False
 
@@ -504,34 +692,33 @@ def _remove_garbage_ocr_lines(md: str) -> str:
        and truncate everything from there onward
     """
     lines = md.split("\n")
-    # First pass: tag lines
-    tagged: list[tuple[str, bool]] = []  # (line, is_garbage)
-    for line in lines:
-        if not line.strip():
-            tagged.append((line, False))
-        else:
-            tagged.append((line, _is_garbage_line(line)))
-
-    # Second pass: find truncation point using rolling window
+    # First pass: tag lines — one flag byte per line, parallel to `lines`
+    flags = bytearray(len(lines))
+    for i, line in enumerate(lines):
+        if line.strip():
+            flags[i] = _is_garbage_line(line)
+
+    # Second pass: find truncation point using a rolling window with a
+    # running garbage count (deque pops are O(1), unlike list.pop(0))
     WINDOW = 8
-    non_empty_count = 0
-    garbage_in_window: list[bool] = []
-    truncate_at = len(tagged)
+    window: deque[int] = deque(maxlen=WINDOW)
+    running = 0
+    truncate_at = len(lines)
 
-    for i, (line, is_garb) in enumerate(tagged):
+    for i, line in enumerate(lines):
         if not line.strip():
             continue
-        garbage_in_window.append(is_garb)
-        non_empty_count += 1
-        if len(garbage_in_window) > WINDOW:
-            garbage_in_window.pop(0)
+        if len(window) == WINDOW:
+            running -= window[0]
+        is_garb = flags[i]
+        window.append(is_garb)
+        running += is_garb
         # Check window: if >60% is garbage, truncate here
-        if (len(garbage_in_window) == WINDOW
-                and sum(garbage_in_window) > WINDOW * 0.6):
+        if len(window) == WINDOW and running > WINDOW * 0.6:
             # Backtrack to the first garbage line in this window
             backtrack = WINDOW
             for j in range(i, -1, -1):
-                if not tagged[j][0].strip():
+                if not lines[j].strip():
                     continue
                 backtrack -= 1
                 if backtrack <= 0:
@@ -540,13 +727,9 @@ def _remove_garbage_ocr_lines(md: str) -> str:
             break
 
     # Build result: keep lines up to truncation point, skip garbage
-    cleaned = []
-    for i, (line, is_garb) in enumerate(tagged):
-        if i >= truncate_at:
-            break
-        if is_garb:
-            continue
-        cleaned.append(line)
+    cleaned = [
+        line for i, line in enumerate(lines[:truncate_at]) if not flags[i]
+    ]
 
     # Trim trailing blank lines
     while cleaned and not cleaned[-1].strip():
@@ -560,107 +743,284 @@ def convert_pdf_to_markdown(file_bytes: bytes, on_status=None) -> str:
 
     Pipeline:
     0. OCR if no text layer detected (scanned PDF)
-    1. Analyze fonts — detect OCR documents
-    2. Detect recurring headers/footers across pages
-    3. Remove handwritten margin paraphs (non-OCR only)
-    4. Convert to markdown via pymupdf4llm
-    5. Strip OCR backtick artifacts (OCR only)
-    6. Remove garbage OCR lines (OCR only)
-    7. Remove headers/footers and page numbers
-    8. Fix header formatting (redundant bold)
-    9. Merge broken lines into paragraphs
+    1. Single-pass analysis: font stats (OCR detection), recurring
+       headers/footers, margin-paraph redaction (non-OCR only)
+    2. Convert to markdown via pymupdf4llm
+    3. Strip OCR backtick artifacts (OCR only)
+    4. Remove garbage OCR lines (OCR only)
+    5. Remove headers/footers and page numbers
+    6. Fix header formatting (redundant bold)
+    7. Merge broken lines into paragraphs
     """
-    # Step 0: OCR if no text layer
-    if _needs_ocr(file_bytes):
+    doc = pymupdf.open(stream=file_bytes, filetype="pdf")
+
+    # Step 0: OCR if no text layer — the detection probe shares the doc
+    # opened above; only an actual OCR run forces a reopen (new bytes)
+    if _needs_ocr(doc):
+        doc.close()
         if on_status:
             on_status("Wykryto skan bez warstwy tekstowej. Uruchamianie OCR...")
         file_bytes = _ocr_pdf(file_bytes)
         if on_status:
             on_status("OCR zakonczone. Przetwarzanie tekstu...")
+        doc = pymupdf.open(stream=file_bytes, filetype="pdf")
 
-    doc = pymupdf.open(stream=file_bytes, filetype="pdf")
-    dominant_font, is_ocr = _get_font_stats(doc)
-    recurring = _find_recurring_texts(doc)
-
-    # For OCR: skip pages with very low text quality (garbled KRS appendixes, etc.)
-    good_pages = None
-    if is_ocr:
-        good_pages = []
-        clean_word_re = re.compile(
-            r'^[a-zA-ZąćęłńóśźżĄĆĘŁŃÓŚŹŻ.,;:\-()"\'„"]+$'
-        )
-        for i in range(len(doc)):
-            text = doc[i].get_text()
-            words = text.split()
-            if not words:
-                continue
-            clean = sum(1 for w in words
-                        if clean_word_re.match(w) and 2 <= len(w) <= 30)
-            if clean / len(words) >= 0.55:
-                good_pages.append(i)
-        good_pages = good_pages or None
-
-    doc.close()
-
-    cleaned_bytes = _clean_pdf(file_bytes, is_ocr, dominant_font)
-
-    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
-        tmp.write(cleaned_bytes)
-        tmp_path = tmp.name
+    is_ocr, recurring, good_pages = _analyze_and_clean(doc, file_bytes)
 
+    # pymupdf4llm accepts the open Document directly — no need to
+    # serialize the cleaned PDF and parse it back from a temp file
     try:
         md_text = pymupdf4llm.to_markdown(
-            tmp_path,
+            doc,
             pages=good_pages,
             ignore_code=is_ocr,
         )
     finally:
-        os.unlink(tmp_path)
+        doc.close()
 
     if is_ocr:
         md_text = _strip_ocr_backticks(md_text)
         md_text = _remove_garbage_ocr_lines(md_text)
 
-    md_text = _remove_headers_footers(md_text, recurring)
-    md_text = _remove_page_numbers(md_text)
-    md_text = _clean_header_formatting(md_text)
+    md_text = _cleanup_md(md_text, recurring)
     return _merge_broken_lines(md_text)
 
 
+# Empty header row, separator, first data row — as one multiline match.
+# [ \t] instead of \s inside rows so a row can't swallow the newlines;
+# rows may be indented (the old line scan stripped before matching).
+_EMPTY_TABLE_HEADER_RE = re.compile(
+    r"^[ \t]*\|[ \t]*(?:\|[ \t]*)+\n"                    # empty header row
+    r"([ \t]*\|[ \t\-:]+(?:\|[ \t\-:]+)+\|?[ \t]*)\n"    # separator row
+    r"([ \t]*\|[^\n]*)",                                 # first data row
+    re.MULTILINE,
+)
+
+
 def _fix_empty_table_headers(md: str) -> str:
     """Fix tables with empty header rows generated by markdownify.
 
     Promotes the first data row to be the header when the header is empty.
+    A single compiled sub over the whole markdown — documents without
+    tables (the common case) cost one C-level scan, no line splitting.
     """
-    lines = md.split("\n")
-    result = []
-    i = 0
-    while i < len(lines):
-        # Detect pattern: empty header row, separator, data row
-        if (
-            i + 2 < len(lines)
-            and re.match(r"^\|\s*(\|\s*)+$", lines[i].strip())  # empty header
-            and re.match(r"^\|[\s\-:]+(\|[\s\-:]+)+\|?\s*$", lines[i + 1].strip())  # separator
-            and lines[i + 2].strip().startswith("|")  # data row
-        ):
-            # Use first data row as header
-            result.append(lines[i + 2])  # promote data row to header
-            result.append(lines[i + 1])  # keep separator
-            i += 3  # skip the empty header, separator, and promoted row
+    if "|" not in md:
+        return md
+    return _EMPTY_TABLE_HEADER_RE.sub(r"\2\n\1", md)
+
+
+# Markdown metacharacters in document text must be escaped so literal
+# asterisks/underscores/etc. survive the round-trip (faithful 1:1, no
+# content reinterpretation) — markdownify does the same.
+_MD_ESCAPE_RE = re.compile(r"([\\*_`\[\]])")
+# Characters that change a line's meaning when they open it: headings,
+# tables, blockquotes, rules/lists. Numbered lists are escaped on the
+# period ("1\. tekst") — a backslash before the digit would itself
+# render as a literal backslash.
+_MD_LINE_START_RE = re.compile(r"^(#|\||>|[-+]\s)", re.MULTILINE)
+_MD_LINE_START_NUM_RE = re.compile(r"^(\d+)\.(\s)", re.MULTILINE)
+
+
+def _escape_md(text: str) -> str:
+    return _MD_ESCAPE_RE.sub(r"\\\1", text)
+
+
+def _escape_md_line_starts(text: str) -> str:
+    text = _MD_LINE_START_RE.sub(r"\\\1", text)
+    return _MD_LINE_START_NUM_RE.sub(r"\1\\.\2", text)
+
+
+def _inline_md(node, escape: bool = True) -> str:
+    """Markdown for the inline content of an lxml element (text + children).
+
+    Text and tail nodes are Markdown-escaped unless `escape` is False
+    (code content must stay verbatim).
+    """
+    esc = _escape_md if escape else str
+    parts = [esc(node.text or "")]
+    for child in node:
+        parts.append(_inline_el_md(child, escape))
+        parts.append(esc(child.tail or ""))
+    return "".join(parts)
+
+
+def _inline_el_md(el, escape: bool = True) -> str:
+    """Markdown for a single inline element."""
+    tag = el.tag
+    if tag == "br":
+        return "  \n"  # hard break — a bare \n renders as a space
+    if tag == "img":
+        return ""  # images are dropped, like markdownify(strip=["img"])
+    if tag == "code":
+        content = _inline_md(el, escape=False)
+        return f"`{content}`" if content.strip() else content
+    content = _inline_md(el, escape)
+    if not content.strip():
+        return content
+    if tag in ("strong", "b"):
+        return f"**{content}**"
+    if tag in ("em", "i"):
+        return f"*{content}*"
+    if tag in ("s", "del", "strike"):
+        return f"~~{content}~~"  # mammoth emits <s> for struck runs
+    if tag == "a":
+        href = el.get("href", "")
+        return f"[{content}]({href})" if href else content
+    return content  # u, sup, sub, span, ... — keep the text
+
+
+def _table_md(el) -> str:
+    """Markdown table from an HTML table. The first row becomes the
+    header — same net result as the empty-header fix applied to
+    markdownify output (mammoth emits headerless tables)."""
+    rows: list[list[str]] = []
+    for tr in el.iter("tr"):
+        # A literal pipe inside a cell would break the row
+        cells = [
+            " ".join(_inline_md(cell).split()).replace("|", "\\|")
+            for cell in tr
+            if cell.tag in ("td", "th")
+        ]
+        if cells:
+            rows.append(cells)
+    if not rows:
+        return ""
+    width = max(len(row) for row in rows)
+    for row in rows:
+        row.extend([""] * (width - len(row)))
+    lines = ["| " + " | ".join(rows[0]) + " |"]
+    lines.append("| " + " | ".join(["---"] * width) + " |")
+    lines.extend("| " + " | ".join(row) + " |" for row in rows[1:])
+    return "\n".join(lines)
+
+
+def _list_md(el, depth: int = 0) -> str:
+    """Markdown list from an HTML ul/ol, with nested lists indented."""
+    lines: list[str] = []
+    ordered = el.tag == "ol"
+    indent = "    " * depth
+    index = 1
+    for li in el:
+        if li.tag != "li":
+            continue
+        head = [_escape_md(li.text or "")]
+        sublists: list[str] = []
+        for child in li:
+            if child.tag in ("ul", "ol"):
+                sublists.append(_list_md(child, depth + 1))
+            elif child.tag == "p":
+                head.append(_inline_md(child))
+            else:
+                head.append(_inline_el_md(child))
+            head.append(_escape_md(child.tail or ""))
+        text = " ".join("".join(head).split())
+        marker = f"{index}." if ordered else "-"
+        lines.append(f"{indent}{marker} {text}")
+        lines.extend(sublists)
+        index += 1
+    return "\n".join(lines)
+
+
+def _block_md(el, blocks: list[str]) -> None:
+    """Append the markdown for one block-level element to `blocks`."""
+    tag = el.tag
+    if isinstance(tag, str) and len(tag) == 2 and tag[0] == "h" and tag[1].isdigit():
+        level = int(tag[1])
+        text = " ".join(_inline_md(el).split())
+        if text:
+            blocks.append("#" * level + " " + text)
+    elif tag == "p":
+        text = _escape_md_line_starts(_inline_md(el).strip())
+        if text:
+            blocks.append(text)
+    elif tag in ("ul", "ol"):
+        text = _list_md(el)
+        if text:
+            blocks.append(text)
+    elif tag == "table":
+        text = _table_md(el)
+        if text:
+            blocks.append(text)
+    elif tag == "pre":
+        blocks.append("```\n" + _inline_md(el, escape=False).strip("\n") + "\n```")
+    elif tag == "hr":
+        blocks.append("---")
+    elif tag == "blockquote":
+        inner: list[str] = []
+        for child in el:
+            _block_md(child, inner)
+        text = _inline_md(el).strip()
+        if text and not inner:
+            inner.append(_escape_md_line_starts(text))
+        blocks.extend("> " + b.replace("\n", "\n> ") for b in inner)
+    else:
+        # Unknown container (div etc.) — recurse into block children,
+        # or emit its inline text if there are none
+        if len(el):
+            for child in el:
+                _block_md(child, blocks)
         else:
-            result.append(lines[i])
-            i += 1
-    return "\n".join(result)
+            text = _escape_md_line_starts(_inline_md(el).strip())
+            if text:
+                blocks.append(text)
+
+
+def _mammoth_html_to_md(html: str) -> str:
+    """Convert mammoth's restricted HTML subset straight to Markdown.
+
+    mammoth emits a small, predictable tag set (headings, paragraphs,
+    inline emphasis, lists, tables, links), so one walk over an lxml
+    tree is far cheaper than the general-purpose BeautifulSoup pipeline
+    inside markdownify. Images are dropped, matching the previous
+    markdownify(strip=["img"]) call.
+    """
+    if not html.strip():
+        return ""
+    root = lxml_html.fromstring("<div>" + html + "</div>")
+    blocks: list[str] = []
+    if root.text and root.text.strip():
+        blocks.append(_escape_md_line_starts(_escape_md(root.text.strip())))
+    for child in root:
+        _block_md(child, blocks)
+        if child.tail and child.tail.strip():
+            blocks.append(
+                _escape_md_line_starts(_escape_md(child.tail.strip()))
+            )
+    return "\n\n".join(blocks)
+
+
+def _markdownify_fallback(html: str) -> str:
+    """markdownify with the lxml parser when available — BeautifulSoup's
+    default html.parser is pure Python and several times slower."""
+    if lxml_html is not None:
+        try:
+            from bs4 import BeautifulSoup
+            from markdownify import MarkdownConverter
+
+            soup = BeautifulSoup(html, "lxml")
+            converter = MarkdownConverter(heading_style="ATX", strip=["img"])
+            return converter.convert_soup(soup)
+        except Exception:
+            pass
+    return markdownify(html, heading_style="ATX", strip=["img"])
 
 
 def convert_docx_to_markdown(file_bytes: bytes) -> str:
-    """Convert DOCX bytes to Markdown via mammoth (DOCX->HTML) + markdownify (HTML->MD).
+    """Convert DOCX bytes to Markdown via mammoth (DOCX->HTML) + a direct
+    lxml tree walk (HTML->MD), falling back to markdownify.
 
     Faithful 1:1 conversion — no content modification or summarization.
     """
     buf = io.BytesIO(file_bytes)
     result = mammoth.convert_to_html(buf)
     html = result.value
-    md_text = markdownify(html, heading_style="ATX", strip=["img"])
+    md_text = None
+    if lxml_html is not None:
+        try:
+            md_text = _mammoth_html_to_md(html)
+        except Exception:
+            md_text = None  # fall back to the battle-tested path
+    if md_text is None:
+        md_text = _markdownify_fallback(html)
     md_text = _fix_empty_table_headers(md_text)
     return md_text
@@ -1,3 +1,4 @@
+import hashlib
 import os
 
 import streamlit as st
@@ -6,6 +7,20 @@ from converter import convert_pdf_to_markdown, convert_docx_to_markdown
 
 st.set_page_config(page_title="Konwerter do Markdown", layout="wide")
 
+
+# Streamlit reruns the whole script on every widget interaction; cache
+# conversions on the file bytes so tab switches and re-uploads of the
+# same document are served instantly. The underscore argument is
+# excluded from the cache key (callbacks aren't hashable).
+@st.cache_data(show_spinner=False, max_entries=32)
+def _convert_pdf_cached(file_bytes: bytes, _on_status=None) -> str:
+    return convert_pdf_to_markdown(file_bytes, on_status=_on_status)
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _convert_docx_cached(file_bytes: bytes) -> str:
+    return convert_docx_to_markdown(file_bytes)
+
 st.title("Konwerter PDF / DOCX do Markdown")
 st.write("Przeciagnij pliki PDF lub DOCX, a otrzymasz wierny Markdown (konwersja 1:1, bez modyfikacji tresci).")
 
@@ -24,6 +39,9 @@ for uploaded_file in uploaded_files:
     st.subheader(uploaded_file.name)
 
     file_bytes = uploaded_file.read()
+    # Fast content digest — identifies the upload independently of the
+    # filename, so unchanged outputs are not rewritten on every rerun
+    digest = hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
     extension = uploaded_file.name.rsplit(".", 1)[-1].lower()
 
     try:
@@ -32,10 +50,10 @@ for uploaded_file in uploaded_files:
             def update_status(msg):
                 status_placeholder.info(msg)
             with st.spinner(f"Konwersja {uploaded_file.name}..."):
-                md_result = convert_pdf_to_markdown(file_bytes, on_status=update_status)
+                md_result = _convert_pdf_cached(file_bytes, _on_status=update_status)
             status_placeholder.empty()
         elif extension == "docx":
-            md_result = convert_docx_to_markdown(file_bytes)
+            md_result = _convert_docx_cached(file_bytes)
         else:
             st.error(f"Nieobslugiwany format: .{extension}")
             continue
@@ -43,13 +61,18 @@ for uploaded_file in uploaded_files:
         st.error(f"Blad konwersji pliku {uploaded_file.name}: {e}")
         continue
 
-    # Auto-save
+    # Auto-save (skipped when this exact content was already written)
     outputs_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "outputs")
     os.makedirs(outputs_dir, exist_ok=True)
     md_filename = uploaded_file.name.rsplit(".", 1)[0] + ".md"
     output_path = os.path.join(outputs_dir, md_filename)
-    with open(output_path, "w", encoding="utf-8") as f:
-        f.write(md_result)
+    saved_digests = st.session_state.setdefault("saved_digests", {})
+    if saved_digests.get(output_path) != digest:
+        # Encode once in C and write the bytes in one call — skips the
+        # text-IO layer's incremental encoding on multi-MB outputs
+        with open(output_path, "wb") as f:
+            f.write(md_result.encode("utf-8"))
+        saved_digests[output_path] = digest
     st.success(f"Zapisano: outputs/{md_filename}")
 
     tab_source, tab_preview = st.tabs(["Zrodlo Markdown", "Podglad renderowany"])